@@ -1,6 +1,6 @@
 # File: database.py
 import os
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, DateTime, BigInteger
+from sqlalchemy import create_engine, event, text, Column, Index, Integer, String, ForeignKey, DateTime, BigInteger
 from sqlalchemy.orm import declarative_base, sessionmaker
 
 DB_PATH = os.path.expanduser('~/.config/gdrive_sync/files.db')
@@ -16,13 +16,17 @@ class File(Base):
     remote_id = Column(String, unique=True)
     name = Column(String, nullable=False)
     parent_id = Column(Integer, ForeignKey('files.id'))
-    checksum = Column(String(64))  # SHA-256
+    checksum = Column(String(64))  # MD5, comparable with Drive's md5Checksum
     last_modified_local = Column(DateTime)
     last_modified_remote = Column(DateTime)
     sync_status = Column(String(20), nullable=False)
     file_size = Column(BigInteger)
     local_size = Column(BigInteger)
 
+    # local_path and remote_id get unique indexes from their constraints;
+    # tree walks look children up by parent
+    __table_args__ = (Index('ix_files_parent_name', 'parent_id', 'name'),)
+
 
 class SyncHistory(Base):
     __tablename__ = 'sync_history'
@@ -34,11 +38,57 @@ class SyncHistory(Base):
     error_message = Column(String)
 
 
+class SyncState(Base):
+    __tablename__ = 'sync_state'
+    key = Column(String, primary_key=True)  # e.g. Drive changes page token
+    value = Column(String)
+
+
 # Initialize engine and session
-engine = create_engine(f'sqlite:///{DB_PATH}')
-Session = sessionmaker(bind=engine)
+# Sync workers share the session's connection under a lock, so allow
+# it to be used outside the thread that opened it
+engine = create_engine(f'sqlite:///{DB_PATH}', connect_args={'check_same_thread': False})
+# Records are cached for the life of a sync, so keep their loaded state across commits
+Session = sessionmaker(bind=engine, expire_on_commit=False)
+
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-20000",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA mmap_size=268435456",
+)
+
+
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Enable WAL and tuned settings on every new SQLite connection"""
+    # Stop pysqlite from managing transactions itself so SAVEPOINTs work;
+    # _begin_transaction below emits BEGIN instead
+    dbapi_connection.isolation_level = None
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+@event.listens_for(engine, "begin")
+def _begin_transaction(conn):
+    """Start transactions explicitly, as pysqlite no longer does it for us"""
+    conn.exec_driver_sql("BEGIN")
 
 
 def init_db():
     """Create tables if they don't exist"""
     Base.metadata.create_all(engine)
+    # create_all skips indexes on tables that already exist
+    for index in File.__table__.indexes:
+        index.create(engine, checkfirst=True)
+
+
+def optimize_db():
+    """Let SQLite refresh query planner statistics between sync passes"""
+    # engine.begin() commits on exit; a bare connect() would roll the ANALYZE back
+    with engine.begin() as conn:
+        conn.execute(text("PRAGMA optimize"))
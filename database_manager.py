@@ -1,14 +1,16 @@
 import datetime
 import hashlib
 import os
+from contextlib import contextmanager
 from pathlib import Path
 from typing import Optional, Dict
-from dateutil.parser import parse
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.exc import IntegrityError
 import logging
 
 import database
-from database import File, Session
+from database import File, Session, SyncState
 
 logger = logging.getLogger(__name__)
 
@@ -17,11 +19,70 @@ class DatabaseManager:
     def __init__(self):
         self.session = Session()
         database.init_db()
+        self._by_local: Dict[str, File] = {}
+        self._by_remote: Dict[str, File] = {}
+        self._depth = 0
+        self._load_cache()
+
+    def _load_cache(self):
+        """Index all file records by local path and remote ID."""
+        # populate_existing so rows already in the session are refreshed, not reused
+        rows = self.session.scalars(
+            select(File), execution_options={"populate_existing": True}
+        ).all()
+        self._by_local = {f.local_path: f for f in rows}
+        self._by_remote = {f.remote_id: f for f in rows}
+
+    def _cache_record(self, file_record: File, old_local_path: Optional[str] = None):
+        """Keep the lookup dicts in sync with a created or mutated record."""
+        if old_local_path is not None and old_local_path != file_record.local_path:
+            self._by_local.pop(old_local_path, None)
+        self._by_local[file_record.local_path] = file_record
+        self._by_remote[file_record.remote_id] = file_record
+
+    @contextmanager
+    def begin(self):
+        """Group record updates into a single transaction, committed on exit.
+
+        Nested scopes run in a SAVEPOINT, so a failing subfolder only rolls back
+        its own records and the outermost scope still commits everything else.
+        """
+        savepoint = self.session.begin_nested() if self._depth else None
+        self._depth += 1
+        try:
+            yield self.session
+        except Exception:
+            if savepoint is not None:
+                savepoint.rollback()
+            else:
+                self.session.rollback()
+            self._load_cache()
+            raise
+        finally:
+            self._depth -= 1
+
+        if savepoint is not None:
+            savepoint.commit()
+        else:
+            self.session.commit()
+
+    def commit(self):
+        """Commit any pending record updates."""
+        self.session.commit()
+
+    def get_state(self, key: str) -> Optional[str]:
+        """Read a persisted sync state value."""
+        state = self.session.get(SyncState, key)
+        return state.value if state else None
+
+    def set_state(self, key: str, value: str):
+        """Persist a sync state value, committed with the enclosing transaction."""
+        self.session.merge(SyncState(key=key, value=value))
 
     @staticmethod
     def _parse_datetime(dt_str: Optional[str]) -> Optional[datetime.datetime]:
-        """Parse datetime string from Google Drive."""
-        return parse(dt_str) if dt_str else None
+        """Parse RFC 3339 datetime string from Google Drive."""
+        return datetime.datetime.fromisoformat(dt_str.replace("Z", "+00:00")) if dt_str else None
 
     @staticmethod
     def _get_local_checksum(path: Path) -> Optional[str]:
@@ -29,75 +90,106 @@ class DatabaseManager:
         if not path.exists():
             return None
 
-        md5 = hashlib.md5()
-        with path.open("rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                md5.update(chunk)
-        return md5.hexdigest()
+        # MD5 to stay comparable with Drive's md5Checksum; file_digest runs the
+        # read/update loop in C and reads straight into its own buffer
+        with path.open("rb", buffering=0) as f:
+            return hashlib.file_digest(f, "md5").hexdigest()
 
     @staticmethod
-    def _get_file_modified_time(file_path: Path) -> Optional[datetime.datetime]:
-        """Get the last modified time of a file."""
-        if file_path.exists():
-            mod_time = file_path.stat().st_mtime
-            return datetime.datetime.utcfromtimestamp(mod_time)
+    def _stat(path: Path) -> Optional[os.stat_result]:
+        """Stat a local path once, returning None if it does not exist."""
+        try:
+            return os.stat(path)
+        except FileNotFoundError:
+            return None
+
+    @classmethod
+    def _get_file_modified_time(
+            cls, file_path: Path, st: Optional[os.stat_result] = None
+    ) -> Optional[datetime.datetime]:
+        """Get the last modified time of a file, reusing ``st`` when given."""
+        st = st or cls._stat(file_path)
+        if st is not None:
+            return datetime.datetime.fromtimestamp(st.st_mtime, tz=datetime.timezone.utc).replace(tzinfo=None)
         logger.warning("File does not exist: %s", file_path)
         return None
 
     def get_file_by_local_path(self, local_path: Path) -> Optional[File]:
         """Retrieve file record from the database by local path."""
-        return self.session.query(File).filter_by(local_path=str(local_path)).first()
+        key = str(local_path)
+        file_record = self._by_local.get(key)
+        if file_record is None:
+            file_record = self.session.scalar(select(File).where(File.local_path == key))
+            if file_record is not None:
+                self._cache_record(file_record)
+        return file_record
 
     def get_file_by_remote_id(self, remote_id: str) -> Optional[File]:
         """Retrieve file record from the database by remote ID."""
-        return self.session.query(File).filter_by(remote_id=remote_id).first()
+        file_record = self._by_remote.get(remote_id)
+        if file_record is None:
+            file_record = self.session.scalar(select(File).where(File.remote_id == remote_id))
+            if file_record is not None:
+                self._cache_record(file_record)
+        return file_record
+
+    def update_local_modified_time(self, file_record: File, modified_time: datetime.datetime):
+        """Record a new local mtime for a file whose contents did not change."""
+        file_record.last_modified_local = modified_time
+
+    def _prepare_folder_attributes(self, item: Dict, path: Path, parent_id: int) -> Dict:
+        """Prepare attributes for a folder record; folders carry no checksum or sizes."""
+        return {
+            "type": "folder",
+            "local_path": str(path),
+            "remote_id": item["id"],
+            "parent_id": parent_id,
+            "name": item["name"],
+            "sync_status": "synced",
+            "last_modified_remote": self._parse_datetime(item.get("modifiedTime")),
+        }
 
-    def _prepare_file_attributes(
-            self, item: Dict, path: Path, parent_id: int, item_type: str
-    ) -> Dict:
+    def _prepare_file_attributes(self, item: Dict, path: Path, parent_id: int) -> Dict:
         """Prepare attributes for File record creation/update."""
-        checksum = None
-        remote_size = None
-        local_size = None
-
-        if item_type != "folder":
-            checksum = item.get("md5Checksum") or self._get_local_checksum(path)
-            remote_size = int(item.get("size", 0))
-            local_size = path.stat().st_size if path.exists() else 0
+        st = self._stat(path)
+        checksum = (
+            item.get("localChecksum")
+            or item.get("md5Checksum")
+            or (self._get_local_checksum(path) if st is not None else None)
+        )
 
         return {
-            "type": item_type,
+            "type": "file",
             "local_path": str(path),
             "remote_id": item["id"],
             "parent_id": parent_id,
             "name": item["name"],
             "checksum": checksum,
             "last_modified_remote": self._parse_datetime(item.get("modifiedTime")),
-            "last_modified_local": self._get_file_modified_time(path),
+            "last_modified_local": self._get_file_modified_time(path, st),
             "sync_status": "synced",
-            "file_size": remote_size,
-            "local_size": local_size,
+            "file_size": int(item.get("size", 0)),
+            "local_size": st.st_size if st is not None else 0,
         }
 
     def update_file_record(
             self, item: Dict, path: Path, parent_id: int, item_type: str
     ) -> File:
         """Update or create database record for a file/folder."""
-        file_attrs = self._prepare_file_attributes(item, path, parent_id, item_type)
-        remote_id = item["id"]
-
-        # Check for existing record by remote_id
-        existing_file = self.get_file_by_remote_id(remote_id)
-
-        if existing_file:
-            # Update existing record with new attributes
-            for key, value in file_attrs.items():
-                setattr(existing_file, key, value)
-            self.session.commit()
-            return existing_file
+        if item_type == "folder":
+            file_attrs = self._prepare_folder_attributes(item, path, parent_id)
         else:
-            # Create new record if none exists
-            file_record = File(**file_attrs)
-            self.session.add(file_record)
-            self.session.commit()
-            return file_record
\ No newline at end of file
+            file_attrs = self._prepare_file_attributes(item, path, parent_id)
+        cached = self._by_remote.get(item["id"])
+        old_local_path = cached.local_path if cached is not None else None
+
+        # Single INSERT ... ON CONFLICT(remote_id) DO UPDATE; RETURNING hands back
+        # the row as a File and refreshes any copy already in the session
+        stmt = sqlite_insert(File).values(**file_attrs).on_conflict_do_update(
+            index_elements=[File.remote_id], set_=file_attrs
+        )
+        file_record = self.session.scalars(
+            stmt.returning(File), execution_options={"populate_existing": True}
+        ).one()
+        self._cache_record(file_record, old_local_path)
+        return file_record
@@ -1,8 +1,12 @@
-import datetime
+import hashlib
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict
+from typing import Dict, List, Optional, Tuple
 
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseDownload
@@ -23,63 +27,225 @@ EXPORT_MIME_MAP = {
     "application/vnd.google-apps.presentation": ("application/pdf", ".pdf"),
 }
 
+DRIVE_LIST_FIELDS = "nextPageToken,files(id,name,mimeType,modifiedTime,md5Checksum,size)"
+DRIVE_LIST_QUERY = "'%s' in parents and trashed=false"
+DRIVE_CHANGES_FIELDS = (
+    "nextPageToken,newStartPageToken,"
+    "changes(fileId,removed,file(id,name,mimeType,modifiedTime,md5Checksum,size,parents,trashed))"
+)
+CHANGES_TOKEN_KEY = "drive_changes_page_token"
+LIST_BATCH_SIZE = 100  # Google's limit on calls per batch request
+DOWNLOAD_WORKERS = 6
+
+
+class _HashingWriter:
+    """File wrapper that feeds every written chunk into an MD5 digest"""
+
+    def __init__(self, file_handle):
+        self._file_handle = file_handle
+        self._md5 = hashlib.md5()
+
+    def write(self, chunk: bytes) -> int:
+        self._md5.update(chunk)
+        return self._file_handle.write(chunk)
+
+    def hexdigest(self) -> str:
+        return self._md5.hexdigest()
+
 
 class DriveLocalSyncer:
-    def __init__(self):
-        self.service = self.authenticate()
-        self.db_manager = DatabaseManager()
+    def __init__(self, db_manager: DatabaseManager = None):
+        self.credentials = self.load_credentials()
+        self.service = self.authenticate(self.credentials)
+        self._list = self.service.files().list
+        # Pass one manager to both syncers so they share a session and record cache
+        self.db_manager = db_manager or DatabaseManager()
+        # Download workers get their own service and share the DB session under a lock
+        self._db_lock = threading.Lock()
+        self._thread_local = threading.local()
+        # One pool for the syncer's lifetime, so each worker's service and its
+        # connections are reused across folders and passes
+        self._executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS)
+
+    def close(self):
+        """Stop the download workers"""
+        self._executor.shutdown()
+
+    def _thread_service(self):
+        """Drive service owned by the calling worker thread"""
+        service = getattr(self._thread_local, "service", None)
+        if service is None:
+            service = self._thread_local.service = self.authenticate(self.credentials)
+        return service
 
     def sync_folder_structure(self, remote_folder_id: str = "root", local_parent: Path = local_to_drive_syncer.LOCAL_FOLDER):
         """Main entry point for Drive-to-local sync"""
         self._process_folder(remote_folder_id, local_parent, parent_id=0)
+        self.db_manager.commit()
+
+    def sync_changes(self, remote_folder_id: str = "root", local_parent: Path = local_to_drive_syncer.LOCAL_FOLDER):
+        """Incremental Drive-to-local sync driven by the Drive changes feed"""
+        page_token = self.db_manager.get_state(CHANGES_TOKEN_KEY)
+        if page_token is None:
+            # Take the token before the full walk so changes made during it are replayed next time
+            start_token = self.service.changes().getStartPageToken().execute()["startPageToken"]
+            self.sync_folder_structure(remote_folder_id, local_parent)
+            self.db_manager.set_state(CHANGES_TOKEN_KEY, start_token)
+            self.db_manager.commit()
+            return
+
+        while page_token:
+            response = self.service.changes().list(
+                pageToken=page_token, pageSize=1000, fields=DRIVE_CHANGES_FIELDS
+            ).execute()
+            self._apply_changes(response.get("changes", []), remote_folder_id, local_parent)
+            page_token = response.get("nextPageToken")
+            with self.db_manager.begin():
+                self.db_manager.set_state(CHANGES_TOKEN_KEY, page_token or response["newStartPageToken"])
+
+    def _apply_changes(self, changes: List[Dict], remote_folder_id: str, local_parent: Path):
+        """Sync changed items that live under the synced folder"""
+        # Deletions are not synced, so removed and trashed entries are skipped
+        items = [change["file"] for change in changes
+                 if not change.get("removed") and change.get("file") and not change["file"].get("trashed")]
+        folders = [item for item in items if item["mimeType"] == "application/vnd.google-apps.folder"]
+        files = [item for item in items if item["mimeType"] != "application/vnd.google-apps.folder"]
+
+        # Folders first so that files inside newly created folders can be resolved
+        for item in folders:
+            parent = self._resolve_parent(item, remote_folder_id, local_parent)
+            if parent is not None:
+                self._apply_folder_change(item, *parent)
+
+        resolved = []
+        for item in files:
+            parent = self._resolve_parent(item, remote_folder_id, local_parent)
+            if parent is not None:
+                resolved.append((item, *parent))
+        with self.db_manager.begin():
+            list(self._executor.map(lambda args: self._process_file_item(*args), resolved))
+
+    def _resolve_parent(self, item: Dict, remote_folder_id: str, local_parent: Path) -> Optional[Tuple[Path, int]]:
+        """Find the local folder and record id of an item's synced parent"""
+        for parent_remote_id in item.get("parents", []):
+            if parent_remote_id == remote_folder_id:
+                return local_parent, 0
+            parent_record = self.db_manager.get_file_by_remote_id(parent_remote_id)
+            if parent_record and parent_record.type == "folder":
+                return Path(parent_record.local_path), parent_record.id
+        return None
+
+    def _apply_folder_change(self, item: Dict, local_path: Path, parent_id: int):
+        """Update a changed folder, walking it fully if it is new, renamed or moved"""
+        folder_record = self.db_manager.get_file_by_remote_id(item["id"])
+        # A renamed or moved folder gets a new local path, and its children must be
+        # downloaded there and have their records repointed
+        needs_walk = folder_record is None or folder_record.local_path != str(local_path / item["name"])
+        pending = []
+        # Commit the folder's own record before walking it; the walk commits per folder
+        with self.db_manager.begin():
+            self._process_folder_item(item, local_path, parent_id, pending)
+        if needs_walk:
+            for folder_id, folder_path, folder_parent_id in pending:
+                self._process_folder(folder_id, folder_path, folder_parent_id)
 
     def _process_folder(self, remote_folder_id: str, local_path: Path, parent_id: int):
-        """Process folder and its contents"""
-        items = self.service.files().list(
-            q=f"'{remote_folder_id}' in parents",
-            fields="files(id, name, mimeType, modifiedTime, md5Checksum, size)"
-        ).execute().get("files", [])
-
-        for item in items:
-            item["mimeType"] == "application/vnd.google-apps.folder" \
-            and self._process_folder_item(item, local_path, parent_id) \
-            or self._process_file_item(item, local_path, parent_id)
-
-    def _process_folder_item(self, item: Dict, local_path: Path, parent_id: int):
-        """Handle folder items"""
+        """Process folder tree breadth-first, listing each level in batches"""
+        pending = [(remote_folder_id, local_path, parent_id)]
+        while pending:
+            listings = self._list_folders([folder_id for folder_id, _, _ in pending])
+            level, pending = pending, []
+            for folder_id, folder_path, folder_parent_id in level:
+                items = listings.get(folder_id, [])
+                folders = [item for item in items if item["mimeType"] == "application/vnd.google-apps.folder"]
+                files = [item for item in items if item["mimeType"] != "application/vnd.google-apps.folder"]
+
+                with self.db_manager.begin():
+                    # Folder records stay on this thread so parent ids are known
+                    # before their children are queued; file downloads run in parallel
+                    for item in folders:
+                        self._process_folder_item(item, folder_path, folder_parent_id, pending)
+                    list(self._executor.map(
+                        lambda item: self._process_file_item(item, folder_path, folder_parent_id), files
+                    ))
+
+    def _list_folders(self, folder_ids: List[str]) -> Dict[str, List[Dict]]:
+        """List children of several folders using batched, paginated HTTP requests"""
+        listings = {folder_id: [] for folder_id in folder_ids}
+        pending = [(folder_id, None) for folder_id in folder_ids]
+
+        while pending:
+            next_pages = []
+
+            def on_response(request_id, response, exception):
+                if exception:
+                    logger.error(f"Failed to list folder {request_id}: {exception}")
+                    return
+                listings[request_id].extend(response.get("files", []))
+                page_token = response.get("nextPageToken")
+                if page_token:
+                    next_pages.append((request_id, page_token))
+
+            for start in range(0, len(pending), LIST_BATCH_SIZE):
+                batch = self.service.new_batch_http_request(callback=on_response)
+                for folder_id, page_token in pending[start:start + LIST_BATCH_SIZE]:
+                    batch.add(self._list(
+                        q=DRIVE_LIST_QUERY % folder_id,
+                        pageSize=1000,
+                        pageToken=page_token,
+                        fields=DRIVE_LIST_FIELDS
+                    ), request_id=folder_id)
+                batch.execute()
+
+            pending = next_pages
+
+        return listings
+
+    def _process_folder_item(self, item: Dict, local_path: Path, parent_id: int, pending: List[Tuple]):
+        """Handle folder items, queueing the folder for the next listing pass"""
         folder_path = local_path / item["name"]
         folder_path.mkdir(parents=True, exist_ok=True)
         db_folder = self.db_manager.update_file_record(item, folder_path, parent_id, "folder")
-        self._process_folder(item["id"], folder_path, db_folder.id)
+        pending.append((item["id"], folder_path, db_folder.id))
 
     def _process_file_item(self, item: Dict, local_path: Path, parent_id: int):
         """Handle file items"""
-        file_path = local_path / item["name"]
-        self._needs_update(item, file_path) and self._download_file(item, local_path, parent_id)
+        file_path = self._local_file_path(local_path, item["name"], item["mimeType"])
+        if self._needs_update(item, file_path):
+            self._download_file(item, local_path, parent_id)
 
     def _download_file(self, item: Dict, local_path: Path, parent_id: int):
         """Download and update file record"""
         try:
-            downloaded_path = self._perform_download(
+            downloaded_path, item["localChecksum"] = self._perform_download(
                 item["id"], item["name"], local_path, item["mimeType"]
             )
 
-            self.db_manager.update_file_record(item, downloaded_path, parent_id, "file")
+            with self._db_lock:
+                self.db_manager.update_file_record(item, downloaded_path, parent_id, "file")
         except Exception as e:
             logger.error(f"Failed to download {item['name']}: {e}")
 
-    def _perform_download(self, file_id: str, file_name: str, folder_path: Path, mime_type: str) -> Path:
-        """Handle actual file download"""
-        export_mime, extension = EXPORT_MIME_MAP.get(mime_type, (None, None))
-        file_path = folder_path / f"{file_name}{extension if export_mime else ''}"
+    def _perform_download(self, file_id: str, file_name: str, folder_path: Path, mime_type: str) -> Tuple[Path, str]:
+        """Handle actual file download, returning the path and MD5 of the written bytes"""
+        export_mime, _ = EXPORT_MIME_MAP.get(mime_type, (None, None))
+        file_path = self._local_file_path(folder_path, file_name, mime_type)
 
-        request = self.service.files().export_media(fileId=file_id, mimeType=export_mime) if export_mime \
-            else self.service.files().get_media(fileId=file_id)
+        service = self._thread_service()
+        request = service.files().export_media(fileId=file_id, mimeType=export_mime) if export_mime \
+            else service.files().get_media(fileId=file_id)
 
         with file_path.open("wb") as f:
-            self._download_with_progress(request, f, file_name)
+            writer = _HashingWriter(f)
+            self._download_with_progress(request, writer, file_name)
+
+        return file_path, writer.hexdigest()
 
-        return file_path
+    @staticmethod
+    def _local_file_path(folder_path: Path, file_name: str, mime_type: str) -> Path:
+        """Local path of a Drive file, with the export extension for Google Workspace documents"""
+        export_mime, extension = EXPORT_MIME_MAP.get(mime_type, (None, None))
+        return folder_path / f"{file_name}{extension if export_mime else ''}"
 
     @staticmethod
     def _download_with_progress(request, file_handle, file_name: str):
@@ -89,17 +255,35 @@ class DriveLocalSyncer:
             done = False
             while not done:
                 status, done = downloader.next_chunk()
-                status and pbar.update(int(status.progress() * 100) - pbar.n)
+                if status:
+                    pbar.update(int(status.progress() * 100) - pbar.n)
 
     def _needs_update(self, item: Dict, local_path: Path) -> bool:
         """Check if file needs update"""
-        if not local_path.exists():
+        st = self.db_manager._stat(local_path)
+        if st is None:
             return True
 
         remote_mtime = self.db_manager._parse_datetime(item.get("modifiedTime"))
-        local_mtime = datetime.datetime.utcfromtimestamp(local_path.stat().st_mtime)
+        with self._db_lock:
+            file_record = self.db_manager.get_file_by_remote_id(item["id"])
+            recorded_checksum = file_record.checksum if file_record else None
+            recorded_remote_mtime = file_record.last_modified_remote if file_record else None
+
+        # Matching checksums settle it without any size or mtime comparison
+        remote_checksum = item.get("md5Checksum")
+        if remote_checksum:
+            if recorded_checksum == remote_checksum:
+                return False
+        else:
+            # Google Workspace exports have no MD5 or size; re-export only when
+            # Drive's modifiedTime moved past the one recorded at the last download
+            return recorded_remote_mtime is None or \
+                remote_mtime.replace(tzinfo=None) != recorded_remote_mtime.replace(tzinfo=None)
+
+        local_mtime = self.db_manager._get_file_modified_time(local_path, st)
 
-        local_size = local_path.stat().st_size if local_path.exists() else 0
+        local_size = st.st_size
         remote_size = int(item.get("size", 0))
 
         logger.info(f'remote size : {remote_size}, local size : {local_size}')
@@ -109,8 +293,8 @@ class DriveLocalSyncer:
         return (remote_mtime.replace(tzinfo=None) if remote_mtime.tzinfo else remote_mtime) > local_mtime
 
     @staticmethod
-    def authenticate():
-        """Authentication handler"""
+    def load_credentials():
+        """Load stored OAuth credentials, running the consent flow if needed"""
         creds = None
         if Path("token.json").exists():
             creds = Credentials.from_authorized_user_file("token.json", local_to_drive_syncer.SCOPES)
@@ -121,4 +305,11 @@ class DriveLocalSyncer:
             with open("token.json", "w") as token:
                 token.write(creds.to_json())
 
-        return build("drive", "v3", credentials=creds)
\ No newline at end of file
+        return creds
+
+    @staticmethod
+    def authenticate(creds=None):
+        """Authentication handler"""
+        creds = creds or DriveLocalSyncer.load_credentials()
+        http = AuthorizedHttp(creds, http=httplib2.Http(timeout=local_to_drive_syncer.HTTP_TIMEOUT))
+        return build("drive", "v3", http=http, cache_discovery=False)
\ No newline at end of file
@@ -2,23 +2,40 @@ from drive_to_local_syncer import DriveLocalSyncer
 from local_to_drive_syncer import LocalDriveSyncer
 import time
 
+import database
+from database_manager import DatabaseManager
+
 if __name__ == "__main__":
     remote_id = '1Yk7WQFKvSbWaXTPTJT3n9_tZpbdsC_pV'  # obsidian
 
-    # Initialize syncers once
-    download_syncer = DriveLocalSyncer()
-    upload_syncer = LocalDriveSyncer()
+    # Initialize syncers once, sharing one session so neither sees stale records
+    db_manager = DatabaseManager()
+    download_syncer = DriveLocalSyncer(db_manager)
+    upload_syncer = LocalDriveSyncer(db_manager)
+    # Start watching before the first full pass so no local edit is missed
+    upload_syncer.start_watching()
+    first_pass = True
+
+    try:
+        while True:
+            print(f"\nStarting sync at {time.strftime('%Y-%m-%d %H:%M:%S')}")
 
-    while True:
-        print(f"\nStarting sync at {time.strftime('%Y-%m-%d %H:%M:%S')}")
+            # Drive-to-local sync (full walk on first run, then only Drive changes)
+            print("Syncing Drive to local...")
+            download_syncer.sync_changes(remote_id)
 
-        # Drive-to-local sync
-        print("Syncing Drive to local...")
-        download_syncer.sync_folder_structure(remote_id)
+            # Local-to-Drive sync (full walk once, then only watched changes)
+            print("Syncing local to Drive...")
+            if first_pass:
+                upload_syncer.sync_local_to_drive(remote_parent_id=remote_id)
+                first_pass = False
+            else:
+                upload_syncer.sync_local_changes(remote_parent_id=remote_id)
 
-        # Local-to-Drive sync
-        print("Syncing local to Drive...")
-        upload_syncer.sync_local_to_drive(remote_parent_id=remote_id)
+            database.optimize_db()
 
-        print(f"Sync completed. Next sync at {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time() + 1800))}")
-        time.sleep(1800)  # 30 minutes delay (1800 seconds)
+            print(f"Sync completed. Next sync at {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time() + 1800))}")
+            time.sleep(1800)  # 30 minutes delay (1800 seconds)
+    finally:
+        upload_syncer.close()
+        download_syncer.close()
@@ -2,12 +2,19 @@ import datetime
 import logging
 import mimetypes
 import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict
+from typing import Dict, Optional
+import httplib2
 from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaFileUpload
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
 from database_manager import DatabaseManager
 
 logging.basicConfig(
@@ -22,41 +29,144 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 SCOPES = ["https://www.googleapis.com/auth/drive"]
+HTTP_TIMEOUT = 30  # seconds
 LOCAL_FOLDER = Path("/home/septian/gdrive_sync")
+UPLOAD_WORKERS = 6
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+RESUMABLE_UPLOAD_THRESHOLD = 5 * 1024 * 1024  # smaller files go up in a single request
+
+
+class _ChangeQueueHandler(FileSystemEventHandler):
+    """Watchdog handler that queues the paths touched by filesystem events"""
+
+    def __init__(self, changes: queue.Queue):
+        self._changes = changes
+
+    def on_any_event(self, event):
+        self._changes.put(event.src_path)
+        dest_path = getattr(event, "dest_path", None)
+        if dest_path:
+            self._changes.put(dest_path)
 
 
 class LocalDriveSyncer:
-    def __init__(self):
+    def __init__(self, db_manager: DatabaseManager = None):
         logger.info("Initializing LocalDriveSyncer")
-        self.service = self.authenticate()
-        self.db_manager = DatabaseManager()
+        self.credentials = self.load_credentials()
+        self.service = self.authenticate(self.credentials)
+        # Pass one manager to both syncers so they share a session and record cache
+        self.db_manager = db_manager or DatabaseManager()
+        # The DB session and a built service are not thread-safe: upload workers
+        # get their own service and serialize record access through this lock
+        self._db_lock = threading.Lock()
+        self._thread_local = threading.local()
+        # One pool for the syncer's lifetime, so each worker's service and its
+        # connections are reused across folders and passes
+        self._executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
+        self._changes = queue.Queue()
+        self._observer = None
         logger.info("LocalDriveSyncer initialized")
 
+    def close(self):
+        """Stop the upload workers and the filesystem watcher"""
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+        self._executor.shutdown()
+
+    def _thread_service(self):
+        """Drive service owned by the calling worker thread"""
+        service = getattr(self._thread_local, "service", None)
+        if service is None:
+            service = self._thread_local.service = self.authenticate(self.credentials)
+        return service
+
     def sync_local_to_drive(self, local_folder: Path = LOCAL_FOLDER, remote_parent_id: str = None):
         """Main entry point for local-to-Drive sync"""
         remote_parent_id = remote_parent_id or "root"
         logger.info("Starting local-to-Drive sync. Local folder: %s, Remote parent ID: %s",
                     local_folder, remote_parent_id)
-        self._sync_local_folder(local_folder, remote_parent_id)
+        self._sync_local_folder(local_folder, remote_parent_id, parent_db_id=None)
+        self.db_manager.commit()
         logger.info("Local-to-Drive sync completed")
 
-    def _sync_local_folder(self, local_path: Path, remote_parent_id: str):
+    def start_watching(self, local_folder: Path = LOCAL_FOLDER):
+        """Start queueing local filesystem changes for sync_local_changes"""
+        self._observer = Observer()
+        self._observer.schedule(_ChangeQueueHandler(self._changes), str(local_folder), recursive=True)
+        self._observer.start()
+        logger.info("Watching %s for changes", local_folder)
+
+    def sync_local_changes(self, local_folder: Path = LOCAL_FOLDER, remote_parent_id: str = None):
+        """Incremental local-to-Drive sync of the paths queued by the watcher"""
+        remote_parent_id = remote_parent_id or "root"
+        paths = set()
+        while True:
+            try:
+                paths.add(Path(self._changes.get_nowait()))
+            except queue.Empty:
+                break
+        logger.info("Syncing %d changed local paths", len(paths))
+
+        targets = {self._sync_target(path, local_folder) for path in paths} - {None}
+        # A folder sync already covers everything below it
+        targets = {target for target in targets if not any(other in target.parents for other in targets)}
+
+        for target in sorted(targets):
+            if target.parent == local_folder:
+                root_record = self.db_manager.get_file_by_local_path(local_folder)
+                parent_remote_id, parent_db_id = remote_parent_id, root_record.id if root_record else None
+            else:
+                parent_record = self.db_manager.get_file_by_local_path(target.parent)
+                parent_remote_id, parent_db_id = parent_record.remote_id, parent_record.id
+
+            if target.is_dir():
+                self._sync_local_folder(target, parent_remote_id, parent_db_id)
+            else:
+                with self.db_manager.begin():
+                    self._sync_local_file(target, parent_remote_id, parent_db_id)
+        self.db_manager.commit()
+        logger.info("Local change sync completed")
+
+    def _sync_target(self, path: Path, local_folder: Path) -> Optional[Path]:
+        """Pick the path to sync for a change: the topmost ancestor not yet on Drive"""
+        if local_folder not in path.parents or not path.exists():
+            # Deletions are not synced
+            return None
+
+        target = path
+        while target.parent != local_folder and self.db_manager.get_file_by_local_path(target.parent) is None:
+            target = target.parent
+
+        if target.is_dir() and self.db_manager.get_file_by_local_path(target) is not None:
+            # Known folders need no work of their own; their files queue separate events
+            return None
+        return target
+
+    def _sync_local_folder(self, local_path: Path, remote_parent_id: str, parent_db_id: Optional[int]):
         """Process a folder and its contents for sync"""
         logger.info("Processing folder: %s", local_path)
         try:
-            folder_record_remote_id = remote_parent_id
-            if local_path != LOCAL_FOLDER:
-                folder_record = self._get_or_create_folder(local_path, remote_parent_id)
-                logger.debug("Folder record obtained: %s", folder_record)
-                folder_record_remote_id = folder_record.remote_id
+            # Commit the folder record as soon as the folder exists on Drive, so a
+            # later failure inside it can never lose the record and recreate it
+            with self.db_manager.begin():
+                folder_record_remote_id = remote_parent_id
+                if local_path != LOCAL_FOLDER:
+                    folder_record = self._get_or_create_folder(local_path, remote_parent_id, parent_db_id)
+                    logger.debug("Folder record obtained: %s", folder_record)
+                    folder_record_remote_id = folder_record.remote_id
+                    folder_db_id = folder_record.id
+                else:
+                    root_record = self.db_manager.get_file_by_local_path(local_path)
+                    folder_db_id = root_record.id if root_record else None
 
             logger.info("Processing items in folder: %s", local_path)
-            self._process_folder_items(local_path, folder_record_remote_id)
+            self._process_folder_items(local_path, folder_record_remote_id, folder_db_id)
             logger.info("Finished processing folder: %s", local_path)
         except Exception as e:
             logger.error("Error syncing folder %s: %s", local_path, e, exc_info=True)
 
-    def _get_or_create_folder(self, local_path: Path, remote_parent_id: str):
+    def _get_or_create_folder(self, local_path: Path, remote_parent_id: str, parent_db_id: Optional[int]):
         """Get existing or create new folder record"""
         folder_record = self.db_manager.get_file_by_local_path(local_path)
         if folder_record:
@@ -73,13 +183,12 @@ class LocalDriveSyncer:
         }
         created_folder = self.service.files().create(body=folder_metadata, fields='id').execute()
         logger.info("Created new folder on Drive. ID: %s", created_folder['id'])
-        return self._update_folder_record(local_path, created_folder['id'])
+        return self._update_folder_record(local_path, created_folder['id'], parent_db_id)
 
-    def _update_folder_record(self, local_path: Path, remote_id: str):
+    def _update_folder_record(self, local_path: Path, remote_id: str, parent_db_id: Optional[int]):
         """Update database with folder information"""
         logger.debug("Updating folder record for %s with remote ID %s", local_path, remote_id)
-        parent_record = self.db_manager.get_file_by_local_path(local_path.parent)
-        logger.debug("Parent folder record: %s", parent_record.id if parent_record else "None")
+        logger.debug("Parent folder record: %s", parent_db_id)
 
         remote_folder = self.service.files().get(
             fileId=remote_id, fields='id, name, mimeType, modifiedTime'
@@ -87,74 +196,100 @@ class LocalDriveSyncer:
         logger.debug("Retrieved remote folder info: %s", remote_folder)
 
         updated_record = self.db_manager.update_file_record(
-            remote_folder, local_path,
-            parent_record.id if parent_record else None, "folder"
+            remote_folder, local_path, parent_db_id, "folder"
         )
         logger.info("Updated folder record in database for %s", local_path)
         return updated_record
 
-    def _process_folder_items(self, local_path: Path, remote_folder_id: str):
+    def _process_folder_items(self, local_path: Path, remote_folder_id: str, folder_db_id: Optional[int]):
         """Process all items in a folder"""
-        items = list(local_path.iterdir())
+        # DirEntry carries the file type from readdir, so is_dir() needs no stat
+        # except for symlinks, which are still followed as before
+        with os.scandir(local_path) as entries:
+            items = list(entries)
         logger.info("Processing %d items in folder: %s", len(items), local_path)
-        for item in items:
+        folders = [Path(item.path) for item in items if item.is_dir()]
+        files = [Path(item.path) for item in items if not item.is_dir()]
+
+        # Sibling files upload concurrently and commit as one transaction for this
+        # folder; subfolders are walked afterwards, each committing on its own
+        with self.db_manager.begin():
+            list(self._executor.map(lambda item: self._sync_local_file(item, remote_folder_id, folder_db_id), files))
+
+        for item in folders:
             logger.debug("Processing item: %s", item.name)
-            if item.is_dir():
-                self._sync_local_folder(item, remote_folder_id)
-            else:
-                self._sync_local_file(item, remote_folder_id)
+            self._sync_local_folder(item, remote_folder_id, folder_db_id)
 
-    def _sync_local_file(self, local_file_path: Path, remote_parent_id: str):
+    def _sync_local_file(self, local_file_path: Path, remote_parent_id: str, parent_db_id: Optional[int]):
         """Sync individual file to Drive"""
         logger.info("Syncing file: %s", local_file_path)
         try:
-            file_record = self.db_manager.get_file_by_local_path(local_file_path)
+            with self._db_lock:
+                file_record = self.db_manager.get_file_by_local_path(local_file_path)
+                if file_record:
+                    logger.debug("Found existing file record (ID: %s)", file_record.remote_id)
             if file_record:
-                logger.debug("Found existing file record (ID: %s)", file_record.remote_id)
                 self._update_existing_file(file_record, local_file_path)
             else:
                 logger.info("No existing record found. Uploading new file")
-                self._upload_new_file(local_file_path, remote_parent_id)
+                self._upload_new_file(local_file_path, remote_parent_id, parent_db_id)
         except Exception as e:
             logger.error("Error syncing file %s: %s", local_file_path, e, exc_info=True)
 
     def _update_existing_file(self, file_record, local_file_path):
         """Update existing file on Drive"""
         logger.info("Checking if file needs update: %s", local_file_path)
+        with self._db_lock:
+            remote_id, parent_id = file_record.remote_id, file_record.parent_id
+
         if self._needs_update(file_record, local_file_path):
             logger.info("File needs update. Updating: %s", local_file_path)
             media = self._create_media_upload(local_file_path)
             logger.debug("Created media upload for file update")
 
-            updated_file = self.service.files().update(
-                fileId=file_record.remote_id, media_body=media,
-                fields='id, name, modifiedTime'
+            updated_file = self._thread_service().files().update(
+                fileId=remote_id, media_body=media,
+                fields='id, name, modifiedTime, md5Checksum'
             ).execute()
             logger.info("File updated on Drive. New modified time: %s", updated_file.get('modifiedTime'))
 
-            self.db_manager.update_file_record(
-                updated_file, local_file_path, file_record.parent_id, "file"
-            )
+            with self._db_lock:
+                self.db_manager.update_file_record(
+                    updated_file, local_file_path, parent_id, "file"
+                )
             logger.info("Database record updated for file: %s", local_file_path)
         else:
             logger.info("File is up-to-date. No update needed: %s", local_file_path)
 
     def _needs_update(self, file_record, local_file_path) -> bool:
         """Check if local file is newer than remote"""
-        local_mtime = datetime.datetime.utcfromtimestamp(local_file_path.stat().st_mtime)
-        remote_mtime = file_record.last_modified_remote
-
-        file = self.db_manager.get_file_by_local_path(local_file_path)
+        # Only the record reads need the lock; stat and hashing run outside it
+        with self._db_lock:
+            last_modified_local = file_record.last_modified_local
+            remote_mtime = file_record.last_modified_remote
+            checksum = file_record.checksum
+
+        local_mtime = datetime.datetime.fromtimestamp(
+            local_file_path.stat().st_mtime, tz=datetime.timezone.utc
+        ).replace(tzinfo=None)
+
+        logger.info(f"compare time local_mtime <= file_record.last_modified_local -> {local_mtime} <= {last_modified_local} : {local_mtime <= last_modified_local}")
+        if local_mtime <= last_modified_local:
+            return False
 
-        logger.info(f"compare time local_mtime <= file.last_modified_local -> {local_mtime} <= {file.last_modified_local} : {local_mtime <= file.last_modified_local}")
-        if local_mtime <= file.last_modified_local:
+        # A touched but unchanged file still matches the checksum we recorded
+        if checksum and checksum == self.db_manager._get_local_checksum(local_file_path):
+            logger.info("Checksum unchanged for %s, skipping upload", local_file_path)
+            # Record the new mtime so later passes don't hash the file again
+            with self._db_lock:
+                self.db_manager.update_local_modified_time(file_record, local_mtime)
             return False
 
         logger.info("Update check for %s. Local mtime: %s, Remote mtime: %s",
                     local_file_path, local_mtime, remote_mtime)
         return local_mtime > remote_mtime
 
-    def _upload_new_file(self, local_file_path: Path, remote_parent_id: str):
+    def _upload_new_file(self, local_file_path: Path, remote_parent_id: str, parent_db_id: Optional[int]):
         """Upload new file to Drive"""
         logger.info("Starting upload of new file: %s to parent ID %s",
                     local_file_path.name, remote_parent_id)
@@ -162,40 +297,38 @@ class LocalDriveSyncer:
         file_metadata = {'name': local_file_path.name, 'parents': [remote_parent_id]}
         logger.debug("File metadata: %s", file_metadata)
 
-        new_file = self.service.files().create(
+        new_file = self._thread_service().files().create(
             body=file_metadata, media_body=media,
-            fields='id, name, mimeType, modifiedTime'
+            fields='id, name, mimeType, modifiedTime, md5Checksum'
         ).execute()
         logger.info("File uploaded successfully. ID: %s", new_file['id'])
 
-        self._update_new_file_record(local_file_path, new_file)
+        self._update_new_file_record(local_file_path, new_file, parent_db_id)
         logger.info("Database record created for new file: %s", local_file_path)
 
     def _create_media_upload(self, file_path: Path):
         """Create properly configured MediaFileUpload"""
         mime_type, _ = mimetypes.guess_type(str(file_path))
         logger.debug("Detected MIME type %s for file %s", mime_type, file_path)
+        resumable = file_path.stat().st_size > RESUMABLE_UPLOAD_THRESHOLD
         return MediaFileUpload(
             str(file_path),
             mimetype=mime_type or 'application/octet-stream',
-            resumable=True
+            chunksize=UPLOAD_CHUNK_SIZE,
+            resumable=resumable
         )
 
-    def _update_new_file_record(self, local_path: Path, remote_file: Dict):
+    def _update_new_file_record(self, local_path: Path, remote_file: Dict, parent_db_id: Optional[int]):
         """Update database with new file info"""
         logger.debug("Updating database with new file record for %s", local_path)
-        parent_record = self.db_manager.get_file_by_local_path(local_path.parent)
-        logger.debug("Parent record ID: %s", parent_record.id if parent_record else "None")
-
-        self.db_manager.update_file_record(
-            remote_file, local_path,
-            parent_record.id if parent_record else None, "file"
-        )
+        logger.debug("Parent record ID: %s", parent_db_id)
+        with self._db_lock:
+            self.db_manager.update_file_record(remote_file, local_path, parent_db_id, "file")
         logger.info("New file record created in database for %s", local_path)
 
     @staticmethod
-    def authenticate():
-        """Authentication handler"""
+    def load_credentials():
+        """Load stored OAuth credentials, running the consent flow if needed"""
         logger.info("Starting authentication process")
         creds = None
         token_file = "token.json"
@@ -218,4 +351,12 @@ class LocalDriveSyncer:
             logger.info("New credentials obtained and saved to token.json")
 
         logger.info("Authentication successful")
-        return build("drive", "v3", credentials=creds)
+        return creds
+
+    @staticmethod
+    def authenticate(creds=None):
+        """Authentication handler"""
+        creds = creds or LocalDriveSyncer.load_credentials()
+        # One long-lived authorized connection per service; skip the discovery fetch
+        http = AuthorizedHttp(creds, http=httplib2.Http(timeout=HTTP_TIMEOUT))
+        return build("drive", "v3", http=http, cache_discovery=False)